@@ -1,191 +1,245 @@
-import csv
+from __future__ import annotations
+
+import concurrent.futures
+import locale
+import mmap
+import multiprocessing
 import os
 
 import numpy as np
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 
 
 class RatData:
-    """Data Object collected from 1 mouse.
+    """Data Object collected from 1 mouse under 1 isoflurane level.
 
         Attributes:
                 id: the id of mouse.
                 gender: the gender of mouse.
                 genetics: whether the mouse is Tg, TgAD or nTg.
-                metabolite: keys are the metabolite's name, value is a list of [concentration, %SD, /Cr+PCr]
+                iso: Isoflurane level.
+                metab_names: the metabolite names, in spreadsheet order.
+                conc: the concentration of each metabolite in metab_names.
+                sd: the %SD of each metabolite in metab_names.
+                ratio: the /Cr+PCr of each metabolite in metab_names.
+                name_conc: output column name of each value in conc.
+                name_sd: output column name of each value in sd.
+                name_ratio: output column name of each value in ratio.
 
             Representation Invariants:
                 genetics in {Tg, nTg, TgAD}
+                iso in {iso_high, iso_low}
+                conc, sd, ratio, name_conc, name_sd and name_ratio all have len(metab_names) entries
             """
+    __slots__ = ('iso', 'id', 'gender', 'genetics', 'metab_names', 'conc', 'sd', 'ratio',
+                 'name_conc', 'name_sd', 'name_ratio')
+
     # Attribute types
     id: str
     gender: str
     genetics: str
-    metabolite: dict[str, list[int, int, float]]
-
-    def __init__(self, rat_id: str, gender: str, genetics: str, metabolites: dict) -> None:
-        self.iso = None
+    iso: str
+    metab_names: list[str]
+    conc: np.ndarray
+    sd: np.ndarray
+    ratio: np.ndarray
+    name_conc: list[str]
+    name_sd: list[str]
+    name_ratio: list[str]
+
+    def __init__(self, rat_id: str, gender: str, genetics: str, iso: str, metab_names: list[str],
+                 conc: np.ndarray, sd: np.ndarray, ratio: np.ndarray) -> None:
+        self.iso = iso
         self.id = rat_id
         self.gender = gender
         self.genetics = genetics
-        self.metabolites = metabolites
-
-
-class RatDataHighIso(RatData):
-    """Data Object collected from a mouse under high iso.
-
-            Attributes:
-                iso:
-
-            Representation Invariants:
-                iso == "iso_high"
-            """
-    # Attribute types
-    iso: str
-
-    def __init__(self, rat_id: str, gender: str, genetics: str, metabolites: dict) -> None:
-        super().__init__(rat_id, gender, genetics, metabolites)
-        self.iso = "iso_high"
-
-
-class RatDataLowIso(RatData):
-    """Data Object collected from a mouse under low iso.
-
-                Attributes:
-                    iso: Isoflurane level
-
-                Representation Invariants:
-                    iso == "iso_low"
-                """
-    # Attribute types
-    iso: str
-
-    def __init__(self, rat_id: str, gender: str, genetics: str, metabolites: dict) -> None:
-        super().__init__(rat_id, gender, genetics, metabolites)
-        self.iso = "iso_low"
+        self.metab_names = metab_names
+        self.conc = conc
+        self.sd = sd
+        self.ratio = ratio
+        self.name_conc = []
+        self.name_sd = []
+        self.name_ratio = []
 
 
 def read_csv(filename: str, rat_id: str, gender: str, genetics: str, iso: bool):
-    if iso:
-        rat_data = RatDataHighIso(rat_id, gender, genetics, {})
-    else:
-        rat_data = RatDataLowIso(rat_id, gender, genetics, {})
-
-    with open(filename, 'r') as file:
-        reader = csv.reader(file)
-        data_rows = list(reader)
-        for i in range(2, len(data_rows[0]), 3):
-            value = [(data_rows[0][i].strip() + " " + rat_data.iso, float(data_rows[1][i])),
-                     ((data_rows[0][i + 1].strip() + " " + rat_data.iso), int(data_rows[1][i + 1])),
-                     ((data_rows[0][i + 2].strip() + " " + rat_data.iso), float(data_rows[1][i + 2]))]
-            rat_data.metabolites[data_rows[0][i].strip()] = value
+    # The spreadsheet is a header row and a value row; the first two columns are Row/Col,
+    # then every metabolite takes 3 columns: concentration, %SD and /Cr+PCr.
+    # Only those two rows are needed, so map the file and split them out of the buffer in place.
+    with open(filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        header_end = buffer.find(b'\n')
+        row_end = buffer.find(b'\n', header_end + 1)
+        if row_end == -1:
+            row_end = len(buffer)
+        # Same encoding open(filename, 'r') would pick.
+        header = buffer[:header_end].decode(locale.getpreferredencoding(False)).split(',')
+        row = buffer[header_end + 1:row_end].split(b',')
+    names = np.char.strip(np.asarray(header[2:])).reshape(-1, 3)
+    # Parse the whole value row in one call, then take every third column.
+    values = np.asarray(row[2:], dtype=np.float64)
+    sd = values[1::3]
+    if not (np.isfinite(sd).all() and np.array_equal(sd, np.trunc(sd))):
+        raise ValueError("{}: %SD values must be whole numbers, got {}".format(filename, sd.tolist()))
+
+    rat_data = RatData(rat_id, gender, genetics, "iso_high" if iso else "iso_low", names[:, 0].tolist(),
+                       values[0::3], sd.astype(np.int64), values[2::3])
+
+    # Column names for the whole (n, 3) header block at once, then split column-wise.
+    rat_data.name_conc, rat_data.name_sd, rat_data.name_ratio = np.char.add(names, " " + rat_data.iso).T.tolist()
 
     return rat_data
 
 
 def write_csv(rat_high: list[RatData], rat_low: list[RatData], path: str) -> None:
-    filename = path + '/' + "MRS_Data.csv"
+    import pandas as pd
+
+    filename = os.path.join(path, "MRS_Data.csv")
 
     if len(rat_high) < 1 or len(rat_low) < 1:
         print("No rat data available")
         return
 
+    rat_high_field = rat_high[0].metab_names
+    first_high = rat_high[0]
+    first_low = rat_low[0]
     fields = ["Id", "Genotype", "Gender"]
-    rats_data = []
-    plot_data = {'Genotype': [], "iso": []}
-
-    rat_high_field = list(rat_high[0].metabolites.keys())
-    for i in range(len(rat_high_field)):
-        plot_data[rat_high_field[i]] = []
-        for j in range(3):
-            fields.append(rat_high[0].metabolites[rat_high_field[i]][j][0])
-            fields.append(rat_low[0].metabolites[rat_high_field[i]][j][0])
+    fields += [name
+               for columns in zip(first_high.name_conc, first_low.name_conc, first_high.name_sd, first_low.name_sd,
+                                  first_high.name_ratio, first_low.name_ratio)
+               for name in columns]
+
+    # Rats are paired by position, so every rat needs a spreadsheet for both iso levels.
+    if len(rat_high) != len(rat_low):
+        raise ValueError("Got {} {} spreadsheets but {} {} spreadsheets".format(
+            len(rat_high), rat_high[0].iso, len(rat_low), rat_low[0].iso))
+    n_rats = len(rat_high)
+    n_metab = len(rat_high_field)
+
+    # Values are matched to columns by position, so every spreadsheet must list the same metabolites in order.
+    for rat in rat_high + rat_low:
+        if rat.metab_names != rat_high_field:
+            raise ValueError("Rat {} ({}) lists metabolites {}, expected {}".format(
+                rat.id, rat.iso, rat.metab_names, rat_high_field))
+
+    high_conc = np.stack([rat.conc for rat in rat_high])
+    low_conc = np.stack([rat.conc for rat in rat_low])
+    # (rats, metabolites, 6) block ordered like fields:
+    # conc high/low, %SD high/low, /Cr+PCr high/low.
+    values = np.empty((n_rats, n_metab, 6), dtype=np.float64)
+    values[..., 0] = high_conc
+    values[..., 1] = low_conc
+    values[..., 2] = np.stack([rat.sd for rat in rat_high])
+    values[..., 3] = np.stack([rat.sd for rat in rat_low])
+    values[..., 4] = np.stack([rat.ratio for rat in rat_high])
+    values[..., 5] = np.stack([rat.ratio for rat in rat_low])
+
+    genetics = [rat.genetics for rat in rat_high]
+    # One row per rat per iso, high then low.
+    plot_conc = np.stack((high_conc, low_conc), axis=1).reshape(2 * n_rats, n_metab)
+    plot_data = {'Genotype': np.repeat(genetics, 2),
+                 "iso": np.ravel([[high.iso, low.iso] for high, low in zip(rat_high, rat_low)])}
+    plot_data.update(zip(rat_high_field, plot_conc.T))
+
+    # Each plot is independent; pyplot state is not thread-safe, so render them in separate processes.
+    # Each worker gets a batch of metabolites and reuses one figure for all of them.
+    n_workers = max(1, min(os.cpu_count() or 1, n_metab))
+    with multiprocessing.Pool(n_workers) as pool:
+        pool.starmap(boxplots, [(plot_data, rat_high_field[i::n_workers], path) for i in range(n_workers)])
+
+    metabolite_fields = fields[3:]
+    sd_fields = metabolite_fields[2::6] + metabolite_fields[3::6]
+    df = pd.DataFrame(values.reshape(n_rats, n_metab * 6), columns=metabolite_fields)
+    df = df.astype({field: np.int64 for field in sd_fields})
+    df.insert(0, "Id", [rat.id for rat in rat_high])
+    df.insert(1, "Genotype", genetics)
+    df.insert(2, "Gender", [rat.gender for rat in rat_high])
+    # Keep the csv module's excel-style line endings and its spelling of NaN.
+    df.to_csv(filename, index=False, lineterminator="\r\n", na_rep="nan")
+
+
+def boxplots(data, metabolites: list[str], path: str) -> None:
+    # Plotting libraries are only imported by the plot workers; Agg has to be selected before
+    # seaborn pulls in pyplot.
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
 
-    for k in range(len(rat_high)):
-        rat_data = {'Id': rat_high[k].id, 'Gender': rat_high[k].gender, 'Genotype': rat_high[k].genetics}
-        plot_data['Genotype'].append(rat_high[k].genetics)
-        plot_data['Genotype'].append(rat_high[k].genetics)
-        plot_data["iso"].append(rat_high[k].iso)
-        plot_data["iso"].append(rat_low[k].iso)
-        for item in rat_high_field:
-            plot_data[item].append(rat_high[k].metabolites[item][0][1])
-            plot_data[item].append(rat_low[k].metabolites[item][0][1])
-            for m in range(3):
-                rat_data[rat_high[k].metabolites[item][m][0]] = rat_high[k].metabolites[item][m][1]
-
-        rats_data.append(rat_data)
-
-    for field in rat_high_field:
-        boxplot(plot_data, field, path)
-
-    with open(filename, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fields)
+    figsize = (1.25, 3)
+    theme = "whitegrid"
 
-        writer.writeheader()
+    # One figure is drawn on and saved for every metabolite in this batch.
+    sns.set_theme(style=theme)
+    fig, ax = plt.subplots(figsize=figsize)
+    data = pd.DataFrame(data)
+    for metabolite in metabolites:
+        boxplot(ax, data, metabolite, path)
+    plt.close(fig)
 
-        writer.writerows(rats_data)
 
+def boxplot(ax, data: pd.DataFrame, metabolite: str, path: str) -> None:
+    import seaborn as sns
 
-def boxplot(data, metabolite: str, path: str) -> None:
-    figsize = (1.25, 3)
-    theme = "whitegrid"
     palette_geno = ['olivedrab', 'darkorange']
     title = "20"
     label = 18
     tick = 15
 
-    plt.figure(figsize=figsize)
-    sns.set_theme(style=theme)
+    ax.clear()
 
-    data = pd.DataFrame(data)
     # print(data)
     genotypes = ["nTg", "Tg", "TgAD"]
     x = 'Genotype'
     y = metabolite
 
 
-    ax = sns.boxplot(x=x, y=y, data=data, hue="iso", order=genotypes, palette=palette_geno, showmeans=True,
-                     meanprops={"marker": "o", "markerfacecolor": "white", "markeredgecolor": "black",
-                                "markersize": "5"})
-    ax = sns.stripplot(data=data, order=genotypes, marker="o", alpha=1, color="black", dodge=0.1)
+    sns.boxplot(x=x, y=y, data=data, hue="iso", order=genotypes, palette=palette_geno, showmeans=True,
+                meanprops={"marker": "o", "markerfacecolor": "white", "markeredgecolor": "black",
+                           "markersize": "5"}, ax=ax)
+    sns.stripplot(data=data, order=genotypes, marker="o", alpha=1, color="black", dodge=0.1, ax=ax)
 
-    plt.title("{} concentration for different genotype mice\n".format(metabolite), fontsize=title)
+    ax.set_title("{} concentration for different genotype mice\n".format(metabolite), fontsize=title)
     ax.set_xlabel("Genotype", fontsize=label)
     ax.set_ylabel("Concentration (mmol)", fontsize=label)
     ax.set_xticklabels(genotypes, size=tick)
 
     # ax.legend_.remove()
 
-    plt.savefig('{}/plots/{}_no_filter.png'.format(path, metabolite), dpi=300, bbox_inches='tight')
+    plot_file = os.path.join(path, 'plots', '{}_no_filter.png'.format(metabolite))
+    ax.figure.savefig(plot_file, dpi=300, bbox_inches='tight')
 
 
 def main():
     output_csv = "C:/Users/Imaris Ryzen/Downloads/MRS"
     rats_high = []
     rats_low = []
+    tasks = []
 
-    for name in os.listdir(output_csv):
-        sub_folder = output_csv + '/' + name
-        if os.path.isdir(sub_folder) and name != "plots":
-            lst = name.strip().split('_')
+    with os.scandir(output_csv) as entries:
+        for entry in entries:
+            if not entry.is_dir() or entry.name == "plots":
+                continue
+            lst = entry.name.strip().split('_')
             rat_id = lst[1]
             genetics = lst[6]
             gender = lst[7]
 
-            for iso in os.listdir(sub_folder):
-                if os.path.isdir(sub_folder + '/' + iso):
-                    input_csv = sub_folder + '/' + iso + '/' + "spreadsheet.csv"
-                    if "high" in iso:
-                        rats_high.append(read_csv(input_csv, rat_id, gender, genetics, True))
-                    else:
-                        rats_low.append(read_csv(input_csv, rat_id, gender, genetics, False))
-                else:
-                    continue
+            with os.scandir(entry.path) as iso_entries:
+                for iso_entry in iso_entries:
+                    if not iso_entry.is_dir():
+                        continue
+                    input_csv = os.path.join(iso_entry.path, "spreadsheet.csv")
+                    tasks.append((input_csv, rat_id, gender, genetics, iso_entry.name.startswith("iso_high")))
+
+    # Every spreadsheet is independent, so overlap the file reads across rats.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2) as executor:
+        results = list(executor.map(lambda task: read_csv(*task), tasks))
 
+    for task, rat_data in zip(tasks, results):
+        if task[4]:
+            rats_high.append(rat_data)
         else:
-            continue
+            rats_low.append(rat_data)
 
     write_csv(rats_low, rats_high, output_csv)
 